@@ -1,39 +1,431 @@
 import os
+import sys
+import hmac
+import time
+import queue
+import logging
+import hashlib
+import secrets
+import asyncio
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 import firebase_admin
 from firebase_admin import credentials, firestore
-from dotenv import load_dotenv
+from google.cloud.firestore_v1.async_client import AsyncClient
+from google.api_core.exceptions import AlreadyExists
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.tl.types import InputMediaGeoPoint, InputGeoPoint
-from telethon.errors import SessionPasswordNeededError
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from telethon.tl.types import InputMediaGeoPoint, InputGeoPoint, InputPeerUser
+from telethon.errors import (
+    SessionPasswordNeededError, FloodWaitError, AuthKeyError, UnauthorizedError,
+    ServerError, TimedOutError, RandomIdDuplicateError, MsgWaitFailedError,
+    MultiError, RPCError
+)
+from telethon.extensions import markdown
+from telethon.helpers import generate_random_long
+from telethon.tl.functions.messages import SendMessageRequest, SendMediaRequest
+from fastapi import FastAPI, Header, HTTPException, Request
+from pydantic import BaseModel, ConfigDict, Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 
 # --- 1. Configuração Inicial ---
-load_dotenv()
 
-# Configuração do Firebase
-if not firebase_admin._apps:
+# Logs vão para uma fila em memória; uma thread (QueueListener, iniciada no
+# lifespan) escreve nos handlers que atendem o logger "uvicorn.error" (no
+# LOGGING_CONFIG padrão do uvicorn eles ficam no pai, "uvicorn"). Assim o
+# event loop nunca fica esperando a escrita no terminal.
+log_queue: queue.Queue = queue.Queue(-1)
+logger = logging.getLogger("api_alerta")
+logger.setLevel(logging.INFO)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+
+
+def effective_handlers(log: logging.Logger) -> list:
+    """Handlers que recebem os registros de `log`, subindo pela hierarquia como o logging faz."""
+    handlers = []
+    while log:
+        handlers.extend(log.handlers)
+        if not log.propagate:
+            break
+        log = log.parent
+    return handlers
+
+
+def start_log_listener() -> QueueListener:
+    uvicorn_log = logging.getLogger("uvicorn.error")
+    handlers = effective_handlers(uvicorn_log)
+    if handlers:
+        # Segue o --log-level / --log-config do uvicorn
+        logger.setLevel(uvicorn_log.getEffectiveLevel())
+    else:
+        # Fora do uvicorn (nenhum handler configurado): escreve direto no stderr
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(levelname)s:     %(message)s"))
+        handlers = [handler]
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+class Settings(BaseSettings):
+    """Variáveis de ambiente (e do .env), lidas uma única vez no import.
+
+    Variável vazia (ex.: TELEGRAM_API_ID=) conta como não definida. O .env só
+    alimenta estes campos, não o os.environ: variáveis lidas por outras
+    bibliotecas (FIRESTORE_EMULATOR_HOST, GOOGLE_*) vão no ambiente de verdade.
+    """
+    model_config = SettingsConfigDict(
+        env_file='.env', env_ignore_empty=True, frozen=True, extra='ignore'
+    )
+
+    telegram_api_id: Optional[int] = None
+    telegram_api_hash: Optional[str] = None
+    warmup_phones: str = ''
+    alert_hmac_secret: Optional[str] = None
+    port: int = 8000
+    web_concurrency: int = 1  # mesmo padrão do uvicorn/gunicorn sem WEB_CONCURRENCY
+
+settings = Settings()
+
+API_ID = settings.telegram_api_id
+API_HASH = settings.telegram_api_hash
+
+if not all([API_ID, API_HASH]):
+    logger.error("❌ ERRO: Faltam credenciais API_ID/API_HASH.")
+
+# Cliente assíncrono único do Firestore, criado no startup (ver lifespan):
+# as chamadas não bloqueiam o event loop e todas as requisições compartilham
+# o mesmo canal gRPC.
+db: Optional[AsyncClient] = None
+
+
+def init_firebase() -> Optional[AsyncClient]:
+    """Configura o Firebase Admin e cria o cliente do Firestore."""
+    if not firebase_admin._apps:
+        try:
+            if os.path.exists("firebase_credentials.json"):
+                cred = credentials.Certificate("firebase_credentials.json")
+                firebase_admin.initialize_app(cred)
+                logger.info("✅ Firebase conectado com sucesso!")
+            else:
+                logger.warning("⚠️ AVISO: Arquivo 'firebase_credentials.json' não encontrado.")
+        except Exception as e:
+            logger.error("❌ Erro ao conectar Firebase: %s", e)
+
+    if not firebase_admin._apps:
+        return None
+
+    fb_app = firebase_admin.get_app()
+    return AsyncClient(
+        project=fb_app.project_id,
+        credentials=fb_app.credential.get_credential()
+    )
+
+
+async def warm_up_firestore():
+    """Abre o canal gRPC (TLS + token) no startup, não no primeiro alerta.
+
+    O keepalive do canal (grpc.keepalive_time_ms=30000) já vem configurado por
+    padrão pelo google-cloud-firestore.
+    """
+    try:
+        await db.collection('_warmup').document('startup').get()
+    except Exception as e:
+        logger.warning("⚠️ Falha ao aquecer conexão com o Firestore: %s", e)
+
+
+def read_field(snapshot, field: str):
+    """Lê um campo do snapshot sem copiar o documento inteiro (None se faltar)."""
     try:
-        if os.path.exists("firebase_credentials.json"):
-            cred = credentials.Certificate("firebase_credentials.json")
-            firebase_admin.initialize_app(cred)
-            print("✅ Firebase conectado com sucesso!")
+        return snapshot.get(field)
+    except KeyError:
+        return None
+
+
+# Os códigos do Telegram expiram em ~5 minutos; tentativas de login mais antigas
+# que isso são descartadas (e o campo 'expires_at' permite configurar uma
+# política de TTL no Firestore para apagar as abandonadas).
+LOGIN_ATTEMPT_TTL = 300  # segundos
+
+# Cópia local das tentativas de login (hash + sessão temporária) para o passo 2
+# não precisar ir ao Firestore. A chave é o login_id devolvido no passo 1: se o
+# usuário repetir o passo 1 em outro processo/worker, ele recebe um login_id
+# novo, o cache daqui não é usado e o passo 2 lê a tentativa atual do banco.
+LOGIN_SESSIONS_MAX = 10_000
+login_sessions: "OrderedDict[str, tuple[str, str, str, float]]" = OrderedDict()
+
+
+def remember_login(login_id: str, phone: str, phone_code_hash: str, temp_session: str):
+    login_sessions[login_id] = (phone, phone_code_hash, temp_session, time.monotonic() + LOGIN_ATTEMPT_TTL)
+
+    # Todas as entradas têm o mesmo TTL, então as mais antigas ficam no começo
+    now = time.monotonic()
+    while login_sessions and (
+        len(login_sessions) > LOGIN_SESSIONS_MAX
+        or next(iter(login_sessions.values()))[3] <= now
+    ):
+        login_sessions.popitem(last=False)
+
+
+def recall_login(login_id: Optional[str], phone: str) -> Optional[tuple[str, str]]:
+    if not login_id:
+        return None
+    entry = login_sessions.get(login_id)
+    if entry and entry[0] == phone and entry[3] > time.monotonic():
+        return entry[1], entry[2]
+    login_sessions.pop(login_id, None)
+    return None
+
+# --- Cache de clientes Telegram ---
+# Mantém os clientes autorizados conectados entre alertas (LRU com TTL),
+# evitando refazer o handshake MTProto a cada requisição.
+CLIENT_CACHE_MAX = 256
+CLIENT_CACHE_TTL = 900  # segundos sem uso até o cliente ser descartado
+CLIENT_CACHE_SWEEP_INTERVAL = 60
+
+
+class CachedClient:
+    """Entrada do cache: o cliente, o último uso e quantos envios o usam agora."""
+
+    def __init__(self, client: TelegramClient):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.retired = False  # fora do cache; desconecta quando o último envio soltar
+        # Por cliente: a reconexão lenta de um usuário não trava a dos outros
+        self.reconnect_lock = asyncio.Lock()
+
+    async def reconnect(self):
+        """Reconecta se a conexão caiu (uma reconexão por vez para este cliente)."""
+        async with self.reconnect_lock:
+            if not self.client.is_connected():
+                await self.client.connect()
+
+
+client_cache: "OrderedDict[str, CachedClient]" = OrderedDict()
+client_cache_lock = asyncio.Lock()
+
+# Última vez que a sessão de cada telefone foi confirmada como autorizada.
+# Dentro desse intervalo, reconectar não repete o is_user_authorized().
+AUTH_CHECK_TTL = 60  # segundos
+auth_ok: dict[str, float] = {}
+
+
+def _retire(entry: CachedClient) -> Optional[TelegramClient]:
+    """Marca a entrada já removida do cache; devolve o cliente se ninguém o estiver usando.
+
+    Chamar com o client_cache_lock. Um cliente em uso só é desconectado
+    quando o envio em andamento terminar (ver get_user_client).
+    """
+    entry.retired = True
+    return None if entry.in_use else entry.client
+
+
+async def _checkout_user_client(phone: str, session_str: str) -> CachedClient:
+    stale = None
+    async with client_cache_lock:
+        entry = client_cache.get(phone)
+        if entry:
+            if time.monotonic() - entry.last_used < CLIENT_CACHE_TTL and entry.client.is_connected():
+                entry.in_use += 1
+                entry.last_used = time.monotonic()
+                client_cache.move_to_end(phone)
+                return entry
+            del client_cache[phone]
+            stale = _retire(entry)
+
+    if stale:
+        await stale.disconnect()
+
+    client = TelegramClient(StringSession(session_str), API_ID, API_HASH)
+    await client.connect()
+    if time.monotonic() - auth_ok.get(phone, 0) >= AUTH_CHECK_TTL:
+        if not await client.is_user_authorized():
+            auth_ok.pop(phone, None)
+            await client.disconnect()
+            raise HTTPException(401, "Sessão expirou.")
+        auth_ok[phone] = time.monotonic()
+
+    evicted = []
+    async with client_cache_lock:
+        # Outra requisição pode ter conectado o mesmo usuário enquanto isso
+        entry = client_cache.get(phone)
+        if entry:
+            evicted.append(client)
+            client_cache.move_to_end(phone)
         else:
-            print("⚠️ AVISO: Arquivo 'firebase_credentials.json' não encontrado.")
+            entry = client_cache[phone] = CachedClient(client)
+        entry.in_use += 1
+        entry.last_used = time.monotonic()
+        if len(client_cache) > CLIENT_CACHE_MAX:
+            # Remove os ociosos mais antigos; os que estão enviando ficam, e o
+            # cache passa do limite até eles terminarem
+            idle = [p for p, e in client_cache.items() if not e.in_use]
+            for old_phone in idle[:len(client_cache) - CLIENT_CACHE_MAX]:
+                evicted.append(client_cache.pop(old_phone).client)
+
+    for old in evicted:
+        await old.disconnect()
+    return entry
+
+
+@asynccontextmanager
+async def get_user_client(phone: str, session_str: str):
+    """Empresta a entrada do cache com o cliente conectado do usuário.
+
+    Enquanto o bloco `async with` roda, o cliente não é desconectado por
+    descarte, LRU ou pela limpeza de ociosos.
+    """
+    entry = await _checkout_user_client(phone, session_str)
+    try:
+        yield entry
+    finally:
+        async with client_cache_lock:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            release = entry.retired and not entry.in_use
+        if release:
+            await entry.client.disconnect()
+
+
+async def discard_user_client(phone: str):
+    """Remove o cliente do cache (sessão trocada ou conexão com erro)."""
+    async with client_cache_lock:
+        entry = client_cache.pop(phone, None)
+        client = _retire(entry) if entry else None
+    if client:
+        await client.disconnect()
+
+
+async def sweep_client_cache():
+    """Tarefa de fundo que desconecta os clientes ociosos além do TTL."""
+    while True:
+        await asyncio.sleep(CLIENT_CACHE_SWEEP_INTERVAL)
+        now = time.monotonic()
+        async with client_cache_lock:
+            expired = [
+                phone for phone, entry in client_cache.items()
+                if not entry.in_use and now - entry.last_used >= CLIENT_CACHE_TTL
+            ]
+            clients = [client_cache.pop(phone).client for phone in expired]
+        for phone in [p for p, checked in auth_ok.items() if now - checked >= AUTH_CHECK_TTL]:
+            del auth_ok[phone]
+        for client in clients:
+            await client.disconnect()
+
+
+# --- Pool de clientes para login ---
+# Clientes com sessão virgem já conectados ao Telegram. Cada um é usado em um
+# único login (a chave de autorização fica presa à sessão temporária salva no
+# banco), então o pool é reabastecido em segundo plano após cada retirada.
+LOGIN_POOL_SIZE = 8
+
+login_pool: asyncio.Queue = asyncio.Queue(maxsize=LOGIN_POOL_SIZE)
+_background_tasks: set = set()
+
+
+def _spawn(coro):
+    """Dispara uma tarefa de fundo mantendo uma referência até ela terminar."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _new_login_client() -> TelegramClient:
+    client = TelegramClient(StringSession(), API_ID, API_HASH)
+    await client.connect()
+    return client
+
+
+async def refill_login_pool():
+    """Coloca mais um cliente conectado no pool."""
+    try:
+        client = await _new_login_client()
     except Exception as e:
-        print(f"❌ Erro ao conectar Firebase: {e}")
+        logger.warning("⚠️ Falha ao preparar cliente de login: %s", e)
+        return
+    try:
+        login_pool.put_nowait(client)
+    except asyncio.QueueFull:
+        await client.disconnect()
 
-db = firestore.client() if firebase_admin._apps else None
 
-API_ID = os.getenv('TELEGRAM_API_ID')
-API_HASH = os.getenv('TELEGRAM_API_HASH')
+async def get_login_client() -> TelegramClient:
+    """Retira um cliente conectado do pool (ou cria um se o pool estiver vazio)."""
+    client = None
+    while not login_pool.empty():
+        candidate = login_pool.get_nowait()
+        if candidate.is_connected():
+            client = candidate
+            break
+        # Conexão caiu enquanto esperava no pool: descarta
+        _spawn(candidate.disconnect())
+        _spawn(refill_login_pool())
+
+    _spawn(refill_login_pool())
+    if client is None:
+        client = await _new_login_client()
+    return client
 
-if not all([API_ID, API_HASH]):
-    print("❌ ERRO: Faltam credenciais API_ID/API_HASH.")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global db
+    log_listener = start_log_listener()
+    logger.info(
+        "Limite de envio: %.1f/s neste processo (ALERT_RATE=%s, WEB_CONCURRENCY=%s)",
+        _worker_rate, ALERT_RATE, settings.web_concurrency
+    )
+    db = init_firebase()
+    if db:
+        await warm_up_firestore()
+    sweeper = asyncio.create_task(sweep_client_cache())
+    workers = [asyncio.create_task(alert_worker()) for _ in range(ALERT_WORKERS)]
+    await asyncio.gather(
+        *(refill_login_pool() for _ in range(LOGIN_POOL_SIZE)),
+        *(warm_up_sender(entry) for entry in WARMUP_PHONES)
+    )
+    yield
+
+    # Termina de enviar os alertas da fila e os que aguardam nova tentativa
+    try:
+        await asyncio.wait_for(drain_alerts(), ALERT_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        waiting = sum(1 for task in _requeue_tasks if not task.done())
+        logger.error(
+            "❌ Desligando com %d alerta(s) na fila e %d aguardando nova tentativa: não serão enviados.",
+            alert_queue.qsize(), waiting
+        )
+
+    tasks = [sweeper, *workers, *_background_tasks]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Desconecta os clientes ociosos do pool de login e os clientes em cache
+    clients = []
+    while not login_pool.empty():
+        clients.append(login_pool.get_nowait())
+    async with client_cache_lock:
+        clients.extend(entry.client for entry in client_cache.values())
+        client_cache.clear()
+    await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+
+    # Fecha o canal gRPC do Firestore
+    if db:
+        await db._firestore_api.transport.close()
+        db = None
+
+    # Escreve o que ainda estiver na fila de logs
+    log_listener.stop()
 
 app = FastAPI(
+    lifespan=lifespan,
     title="API de Alerta (Fix Data Center)",
     description="Correção do erro 'Code Expired' mantendo a sessão temporária no banco."
 )
@@ -47,17 +439,71 @@ class LoginCompleteRequest(BaseModel):
     phone: str = Field(..., description="O mesmo número usado no passo 1")
     code: str = Field(..., description="Código recebido")
     password: Optional[str] = Field(None, description="Senha 2FA (opcional)")
+    login_id: Optional[str] = Field(None, description="login_id devolvido pelo passo 1 (opcional)")
 
 class AlertRequest(BaseModel):
+    # Validação feita pelo pydantic-core: payload inválido é recusado antes
+    # de qualquer chamada ao Telegram
+    model_config = ConfigDict(str_strip_whitespace=True, frozen=True)
+
     phone: str
-    contact_phone: str
+    contact_phone: str = Field(..., pattern=r'^\+?\d{6,15}$', description="Telefone do contato")
     message: str
-    latitude: float
-    longitude: float
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+
+    # Obrigatórios quando ALERT_HMAC_SECRET está configurado (a assinatura
+    # vai no header X-Signature)
+    ts: Optional[int] = Field(None, description="Unix timestamp da requisição")
+    nonce: Optional[str] = Field(None, pattern=r'^[A-Za-z0-9_-]{16,64}$', description="Valor único por requisição")
+
+class StatusResponse(BaseModel):
+    status: str
+    message: str
+
+class LoginStartResponse(StatusResponse):
+    login_id: str
 
 # --- 3. Endpoints de Autenticação ---
 
-@app.post("/autenticacao/iniciar")
+def flood_wait_exception(e: FloodWaitError) -> HTTPException:
+    return HTTPException(
+        429, f"Muitas tentativas. Aguarde {e.seconds}s.",
+        headers={'Retry-After': str(e.seconds)}
+    )
+
+
+async def sign_in(client: TelegramClient, request: LoginCompleteRequest, phone_code_hash: str):
+    """Faz o login (com 2FA se preciso), traduzindo os erros do Telegram para HTTP.
+
+    Só erros do Telegram viram HTTPException; o resto sobe para o FastAPI.
+    """
+    try:
+        try:
+            # Tenta logar
+            await client.sign_in(
+                phone=request.phone,
+                code=request.code,
+                phone_code_hash=phone_code_hash
+            )
+        except SessionPasswordNeededError:
+            if not request.password:
+                raise HTTPException(401, "Senha 2FA necessária. Preencha o campo 'password'.")
+            try:
+                await client.sign_in(password=request.password)
+            except FloodWaitError:
+                raise
+            except RPCError as e_pass:
+                raise HTTPException(401, f"Senha 2FA incorreta: {str(e_pass)}")
+
+    except FloodWaitError as e:
+        raise flood_wait_exception(e)
+    except RPCError as e:
+        # Se der erro, pode ser código errado mesmo
+        raise HTTPException(400, f"Erro no login: {str(e)}")
+
+
+@app.post("/autenticacao/iniciar", response_model=LoginStartResponse)
 async def login_step_1(request: LoginStartRequest):
     """
     PASSO 1: Pede o código e SALVA A SESSÃO TEMPORÁRIA + HASH no Firebase.
@@ -66,9 +512,8 @@ async def login_step_1(request: LoginStartRequest):
     if not db:
         raise HTTPException(500, "Erro interno: Banco de dados desconectado.")
 
-    # Cria uma sessão virgem
-    client = TelegramClient(StringSession(), API_ID, API_HASH)
-    await client.connect()
+    # Pega uma sessão virgem já conectada do pool
+    client = await get_login_client()
     
     try:
         sent_code = await client.send_code_request(request.phone)
@@ -76,24 +521,33 @@ async def login_step_1(request: LoginStartRequest):
         # O PULO DO GATO: Salvamos o estado atual da conexão (que já sabe qual DC usar)
         temp_session_string = client.session.save()
         
+        # Identifica esta tentativa (uma nova a cada passo 1)
+        login_id = secrets.token_urlsafe(16)
+
         # Salvamos tudo na tabela temporária
-        db.collection('login_attempts').document(request.phone).set({
+        await db.collection('login_attempts').document(request.phone).set({
+            'login_id': login_id,
             'phone_code_hash': sent_code.phone_code_hash,
             'temp_session': temp_session_string, # <--- Importante para não dar erro de DC
-            'created_at': firestore.SERVER_TIMESTAMP
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=LOGIN_ATTEMPT_TTL)
         })
+        remember_login(login_id, request.phone, sent_code.phone_code_hash, temp_session_string)
         
         return {
             "status": "sucesso", 
-            "message": f"Código enviado para {request.phone}."
+            "message": f"Código enviado para {request.phone}.",
+            "login_id": login_id
         }
-    except Exception as e:
+    except FloodWaitError as e:
+        raise flood_wait_exception(e)
+    except RPCError as e:
         raise HTTPException(status_code=400, detail=f"Erro ao solicitar código: {str(e)}")
     finally:
         await client.disconnect()
 
 
-@app.post("/autenticacao/finalizar")
+@app.post("/autenticacao/finalizar", response_model=StatusResponse)
 async def login_step_2(request: LoginCompleteRequest):
     """
     PASSO 2: Recupera a sessão temporária e finaliza o login.
@@ -101,16 +555,29 @@ async def login_step_2(request: LoginCompleteRequest):
     if not db:
         raise HTTPException(500, "Banco de dados desconectado.")
 
-    # 1. Busca os dados temporários no Firebase
+    # 1. Busca os dados temporários (cache local primeiro, depois o Firebase)
     doc_ref = db.collection('login_attempts').document(request.phone)
-    doc = doc_ref.get()
+    cached = recall_login(request.login_id, request.phone)
 
-    if not doc.exists:
-        raise HTTPException(400, "Sessão expirada. Faça o passo 1 novamente.")
-    
-    data = doc.to_dict()
-    phone_code_hash = data.get('phone_code_hash')
-    temp_session = data.get('temp_session') # Recupera a conexão do passo 1
+    if cached:
+        phone_code_hash, temp_session = cached
+    else:
+        doc = await doc_ref.get(field_paths=['login_id', 'phone_code_hash', 'temp_session', 'expires_at'])
+
+        if not doc.exists:
+            raise HTTPException(400, "Sessão expirada. Faça o passo 1 novamente.")
+
+        # O passo 1 foi repetido depois deste login_id: a tentativa salva é outra
+        if request.login_id and read_field(doc, 'login_id') != request.login_id:
+            raise HTTPException(400, "Tentativa de login substituída. Use o login_id mais recente.")
+
+        expires_at = read_field(doc, 'expires_at')
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            await doc_ref.delete()
+            raise HTTPException(400, "Sessão expirada. Faça o passo 1 novamente.")
+
+        phone_code_hash = read_field(doc, 'phone_code_hash')
+        temp_session = read_field(doc, 'temp_session') # Recupera a conexão do passo 1
 
     if not temp_session:
         raise HTTPException(400, "Erro de estado: Sessão temporária não encontrada.")
@@ -120,84 +587,399 @@ async def login_step_2(request: LoginCompleteRequest):
     await client.connect()
 
     try:
-        # Tenta logar
-        await client.sign_in(
-            phone=request.phone,
-            code=request.code,
-            phone_code_hash=phone_code_hash
-        )
-        
-    except SessionPasswordNeededError:
-        if not request.password:
-            await client.disconnect()
-            raise HTTPException(401, "Senha 2FA necessária. Preencha o campo 'password'.")
-        
-        try:
-            await client.sign_in(password=request.password)
-        except Exception as e_pass:
-            await client.disconnect()
-            raise HTTPException(401, f"Senha 2FA incorreta: {str(e_pass)}")
-
-    except Exception as e:
+        await sign_in(client, request, phone_code_hash)
+    except BaseException:
+        # Qualquer falha (inclusive inesperada) libera a conexão antes de subir
         await client.disconnect()
-        # Se der erro, pode ser código errado mesmo
-        raise HTTPException(400, f"Erro no login: {str(e)}")
+        raise
 
     # 3. Sucesso! Salva a sessão definitiva
     final_session = client.session.save()
-    await client.disconnect()
 
-    try:
-        # Salva em 'users'
-        db.collection('users').document(request.phone).set({
-            'phone': request.phone,
-            'session_string': final_session,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        })
-        
-        # Limpa a tentativa
-        doc_ref.delete()
-        
-    except Exception as e_db:
-        raise HTTPException(500, f"Login OK, mas erro ao salvar no banco: {e_db}")
+    # Salva em 'users' e limpa a tentativa em um único commit
+    batch = db.batch()
+    batch.set(db.collection('users').document(request.phone), {
+        'phone': request.phone,
+        'session_string': final_session,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    batch.delete(doc_ref)
+
+    # Operações independentes rodam em paralelo
+    db_result, _, _ = await asyncio.gather(
+        batch.commit(),
+        client.disconnect(),
+        # A sessão mudou: o cliente antigo em cache (se houver) não serve mais
+        discard_user_client(request.phone),
+        return_exceptions=True
+    )
+    if isinstance(db_result, Exception):
+        raise HTTPException(500, f"Login OK, mas erro ao salvar no banco: {db_result}")
+
+    if request.login_id:
+        login_sessions.pop(request.login_id, None)
+
+    # Acabou de logar: a sessão nova está autorizada
+    auth_ok[request.phone] = time.monotonic()
     
     return {
         "status": "sucesso", 
         "message": "Login realizado com sucesso!"
     }
 
-# --- 4. Endpoint de Envio (Mesma lógica) ---
+# --- 4. Envio de Alertas ---
+# Os alertas entram em uma fila e são enviados por workers em segundo plano,
+# respeitando o limite de ~30 mensagens/s do Telegram. A requisição HTTP só
+# enfileira e responde na hora.
+ALERT_QUEUE_MAX = 10_000
+ALERT_WORKERS = 4
+ALERT_RATE = 30  # envios por segundo, somando todos os workers do uvicorn
+ALERT_MAX_ATTEMPTS = 5
+ALERT_DRAIN_TIMEOUT = 10  # segundos para esvaziar a fila no desligamento
+
+ALERT_PREFIX = "🚨 *PEDIDO DE SOCORRO* 🚨\n\n"
+
+alert_queue: asyncio.Queue = asyncio.Queue(maxsize=ALERT_QUEUE_MAX)
+
+
+class TokenBucket:
+    """Limitador de taxa compartilhado entre os workers de envio."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+# Cada processo do uvicorn tem seus próprios clientes e fila; o limite de
+# envio é dividido entre eles para o total continuar dentro de ALERT_RATE.
+# O número de processos vem de WEB_CONCURRENCY, que precisa ser o mesmo
+# valor usado para subir os workers (ver os comandos no fim do arquivo).
+_worker_rate = ALERT_RATE / max(1, settings.web_concurrency)
+send_limiter = TokenBucket(_worker_rate, max(1, int(_worker_rate)))
+
+# Destinatários já resolvidos (o access_hash é por conta, por isso a chave
+# inclui o telefone de quem envia). Evita o ResolvePhone a cada alerta.
+PEER_CACHE_MAX = 4096
+peer_cache: "OrderedDict[tuple[str, str], InputPeerUser]" = OrderedDict()
+
+
+async def get_peer(client: TelegramClient, phone: str, contact_phone: str):
+    key = (phone, contact_phone)
+    peer = peer_cache.get(key)
+    if peer is not None:
+        peer_cache.move_to_end(key)
+        return peer
+
+    peer = await client.get_input_entity(contact_phone)
+    peer_cache[key] = peer
+    while len(peer_cache) > PEER_CACHE_MAX:
+        peer_cache.popitem(last=False)
+    return peer
+
+
+# Remetentes (e opcionalmente destinatários) conhecidos para conectar e
+# resolver já no startup: WARMUP_PHONES="+5511999990000:+5511988880000,..."
+WARMUP_PHONES = [p.strip() for p in settings.warmup_phones.split(',') if p.strip()]
+
+
+async def warm_up_sender(entry: str):
+    """Deixa o cliente do remetente em cache (e o destinatário resolvido)."""
+    phone, _, contact_phone = entry.partition(':')
+    if not db:
+        return
+    try:
+        doc = await db.collection('users').document(phone).get(field_paths=['session_string'])
+        session_str = read_field(doc, 'session_string')
+        if not session_str:
+            logger.warning("⚠️ Warm-up: %s não tem sessão salva.", phone)
+            return
+        async with get_user_client(phone, session_str) as cached:
+            if contact_phone:
+                await get_peer(cached.client, phone, contact_phone)
+    except Exception as e:
+        logger.warning("⚠️ Warm-up de %s falhou: %s", phone, e)
+
+
+@lru_cache(maxsize=1024)
+def geo_point(latitude: float, longitude: float) -> InputMediaGeoPoint:
+    """Reaproveita o objeto TL para coordenadas repetidas (ex.: botões fixos)."""
+    return InputMediaGeoPoint(InputGeoPoint(lat=latitude, long=longitude))
+
+
+async def send_in_order(client: TelegramClient, requests: list):
+    """Envia as mensagens na ordem, sem esperar a resposta de cada uma.
+
+    Com ordered=True o Telethon manda tudo no mesmo write, cada requisição
+    embrulhada em invokeAfterMsg da anterior. Uma mensagem que já tinha chegado
+    ao Telegram (RandomIdDuplicateError) conta como enviada; as seguintes, que
+    falharam só por depender dela (MsgWaitFailedError), são reenviadas.
+    """
+    while requests:
+        try:
+            await client(requests, ordered=True)
+            return
+        except RandomIdDuplicateError:
+            # Com uma requisição só o Telethon sobe o erro dela direto
+            return
+        except MultiError as e:
+            for i, error in enumerate(e.exceptions):
+                if error is None or isinstance(error, RandomIdDuplicateError):
+                    continue
+                if isinstance(error, MsgWaitFailedError):
+                    requests = requests[i:]
+                    break
+                raise error
+            else:
+                return
+
+
+def new_random_ids() -> tuple[int, int]:
+    """random_id do texto e da localização, sorteados uma vez por alerta."""
+    return generate_random_long(), generate_random_long()
+
+
+async def deliver_alert(alert: AlertRequest, session_str: str, random_ids: tuple[int, int]):
+    msg = ALERT_PREFIX + alert.message
+    geo = geo_point(alert.latitude, alert.longitude)
+
+    # Texto e localização vão em duas mensagens (mensagens de localização não
+    # têm legenda no Telegram), mas num único round-trip (ver send_in_order).
+    # Requisições TL diretas (sem send_message/send_file). Os random_ids vêm
+    # com o alerta desde o enfileiramento e valem para todas as tentativas,
+    # inclusive as reenfileiradas: o Telegram descarta o que já recebeu.
+    text, entities = markdown.parse(msg)
+    text_id, geo_id = random_ids
+
+    async with get_user_client(alert.phone, session_str) as cached:
+        user_client = cached.client
+        # Se a conexão caiu, reconecta e tenta mais uma vez antes de desistir
+        for attempt in range(2):
+            try:
+                peer = await get_peer(user_client, alert.phone, alert.contact_phone)
+                await send_in_order(user_client, [
+                    SendMessageRequest(
+                        peer=peer, message=text, entities=entities or None, random_id=text_id
+                    ),
+                    SendMediaRequest(peer=peer, media=geo, message='', random_id=geo_id),
+                ])
+                return
+            except (ConnectionError, ServerError, TimedOutError):
+                if attempt:
+                    raise
+                await cached.reconnect()
+
+
+# Alertas para o mesmo destinatário saem um de cada vez, na ordem da fila.
+# Um worker que tira da fila um alerta para um contato que já está recebendo
+# o deixa na fila desse contato e segue para o próximo, em vez de esperar; o
+# worker que está enviando para o contato esvazia essa fila antes de voltar.
+# A concorrência total já é limitada pelo número de workers (ALERT_WORKERS).
+_recipient_backlog: dict[str, deque] = {}  # contato ocupado -> alertas esperando
+
+
+# Erros de rede/servidor que valem nova tentativa (com reconexão)
+TRANSIENT_SEND_ERRORS = (OSError, asyncio.TimeoutError, ServerError, TimedOutError)
+
+
+# Alertas esperando (FloodWait/backoff) para voltar à fila; contam no desligamento
+_requeue_tasks: set = set()
+
+
+async def _requeue_alert(alert: AlertRequest, session_str: str, attempt: int,
+                         random_ids: tuple[int, int], delay: float):
+    await asyncio.sleep(delay)
+    await alert_queue.put((alert, session_str, attempt, random_ids))
+
+
+def schedule_requeue(alert: AlertRequest, session_str: str, attempt: int,
+                     random_ids: tuple[int, int], delay: float):
+    """Reenfileira o alerta depois de `delay` segundos, sem travar o worker."""
+    task = _spawn(_requeue_alert(alert, session_str, attempt, random_ids, delay))
+    _requeue_tasks.add(task)
+    task.add_done_callback(_requeue_tasks.discard)
+
+
+async def drain_alerts():
+    """Espera a fila esvaziar, incluindo os alertas que ainda vão voltar para ela."""
+    while True:
+        await alert_queue.join()
+        # O reenfileiramento é agendado antes do task_done(), então um alerta
+        # em espera sempre aparece aqui quando o join() retorna
+        pending = {task for task in _requeue_tasks if not task.done()}
+        if not pending:
+            return
+        await asyncio.wait(pending)
+
+
+async def process_alert(alert: AlertRequest, session_str: str, attempt: int,
+                        random_ids: tuple[int, int]):
+    """Envia um alerta; erros viram log ou nova tentativa, nunca exceção."""
+    try:
+        async with send_limiter:
+            await deliver_alert(alert, session_str, random_ids)
+    except FloodWaitError as e:
+        # O Telegram pediu para esperar: reenfileira sem travar o worker
+        logger.warning("⏳ FloodWait de %ss para %s, reenfileirando.", e.seconds, alert.phone)
+        schedule_requeue(alert, session_str, attempt, random_ids, e.seconds)
+    except HTTPException as e:
+        logger.error("❌ Alerta de %s descartado: %s", alert.phone, e.detail)
+    except (AuthKeyError, UnauthorizedError) as e:
+        # Sessão revogada: esquece a autorização e não tenta de novo
+        auth_ok.pop(alert.phone, None)
+        await discard_user_client(alert.phone)
+        logger.error("❌ Sessão de %s inválida, alerta descartado: %s", alert.phone, e)
+    except TRANSIENT_SEND_ERRORS as e:
+        # Falha de transporte: o cliente (compartilhado entre os workers)
+        # não serve mais, então reconecta na próxima tentativa
+        await discard_user_client(alert.phone)
+        if attempt + 1 < ALERT_MAX_ATTEMPTS:
+            delay = min(2 ** attempt, 60)
+            logger.warning("⚠️ Erro envio (%s), nova tentativa em %ss.", e, delay)
+            schedule_requeue(alert, session_str, attempt + 1, random_ids, delay)
+        else:
+            logger.error("❌ Erro envio para %s: %s", alert.phone, e)
+    except RPCError as e:
+        # Recusa definitiva do Telegram (destinatário inválido, privacidade...):
+        # repetir não adianta, e o cliente continua bom para os outros envios
+        peer_cache.pop((alert.phone, alert.contact_phone), None)
+        logger.error(
+            "❌ Alerta de %s para %s recusado pelo Telegram: %s",
+            alert.phone, alert.contact_phone, e
+        )
+    except Exception:
+        # Ex.: contact_phone que não resolve para nenhum usuário (ValueError)
+        peer_cache.pop((alert.phone, alert.contact_phone), None)
+        logger.exception("❌ Erro inesperado no alerta de %s, descartado.", alert.phone)
+
+
+async def alert_worker():
+    while True:
+        item = await alert_queue.get()
+        contact_phone = item[0].contact_phone
+        if contact_phone in _recipient_backlog:
+            # Outro worker está enviando para este contato; ele envia este
+            # também (e chama o task_done) quando terminar o atual
+            _recipient_backlog[contact_phone].append(item)
+            continue
+
+        backlog = _recipient_backlog[contact_phone] = deque()
+        try:
+            while True:
+                try:
+                    await process_alert(*item)
+                finally:
+                    alert_queue.task_done()
+                if not backlog:
+                    break
+                item = backlog.popleft()
+        finally:
+            del _recipient_backlog[contact_phone]
+
+
+# --- Assinatura dos alertas ---
+# Com ALERT_HMAC_SECRET definido, cada alerta precisa de ts e nonce no corpo e
+# do header X-Signature: o HMAC-SHA256 (hex) dos bytes exatos do corpo enviado.
+# Como ts e nonce fazem parte do corpo, também ficam cobertos pela assinatura.
+ALERT_SIGNATURE_WINDOW = 300  # segundos de tolerância para o ts
+
+
+def verify_alert_signature(alert: AlertRequest, body: bytes, signature: Optional[str]):
+    if not settings.alert_hmac_secret:
+        return
+    if not signature:
+        raise HTTPException(401, "Assinatura ausente.")
+
+    # Assinatura primeiro: compara com o corpo bruto, antes da normalização do pydantic
+    expected = hmac.new(settings.alert_hmac_secret.encode(), body, hashlib.sha256).hexdigest()
+    # Em bytes: compare_digest recusa str com caracteres fora do ASCII
+    received = signature.strip().lower().encode('latin-1', errors='replace')
+    if not hmac.compare_digest(expected.encode(), received):
+        raise HTTPException(401, "Assinatura inválida.")
+
+    if not (alert.ts and alert.nonce):
+        raise HTTPException(401, "Assinatura ausente.")
+    if abs(time.time() - alert.ts) > ALERT_SIGNATURE_WINDOW:
+        raise HTTPException(401, "Requisição expirada.")
+
+
+async def claim_nonce(nonce: str):
+    """Registra o nonce no Firestore; falha se ele já foi usado (replay)."""
+    try:
+        await db.collection('alert_nonces').document(nonce).create({
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=2 * ALERT_SIGNATURE_WINDOW)
+        })
+    except AlreadyExists:
+        raise HTTPException(401, "Requisição repetida.")
+
+
+@app.post("/enviar-alerta", status_code=202, response_model=StatusResponse)
+async def send_alert(
+    alert: AlertRequest,
+    request: Request,
+    x_signature: Optional[str] = Header(None)
+):
+    # Assinatura e janela de tempo são conferidas antes de qualquer I/O
+    verify_alert_signature(alert, await request.body(), x_signature)
 
-@app.post("/enviar-alerta")
-async def send_alert(alert: AlertRequest):
     if not db:
         raise HTTPException(500, "Banco de dados desconectado.")
 
-    doc = db.collection('users').document(alert.phone).get()
+    user_lookup = db.collection('users').document(alert.phone).get(field_paths=['session_string'])
+    if settings.alert_hmac_secret:
+        # O registro do nonce roda junto com a leitura do usuário
+        doc, _ = await asyncio.gather(user_lookup, claim_nonce(alert.nonce))
+    else:
+        doc = await user_lookup
 
     if not doc.exists:
         raise HTTPException(404, "Usuário não logado.")
     
-    session_str = doc.to_dict().get('session_string')
+    session_str = read_field(doc, 'session_string')
     if not session_str:
         raise HTTPException(401, "Sessão inválida.")
 
-    user_client = TelegramClient(StringSession(session_str), API_ID, API_HASH)
-    
     try:
-        await user_client.connect()
-        if not await user_client.is_user_authorized():
-            raise HTTPException(401, "Sessão expirou.")
+        alert_queue.put_nowait((alert, session_str, 0, new_random_ids()))
+    except asyncio.QueueFull:
+        raise HTTPException(503, "Fila de alertas cheia. Tente novamente.")
 
-        msg = f"🚨 *PEDIDO DE SOCORRO* 🚨\n\n{alert.message}"
-        await user_client.send_message(alert.contact_phone, msg)
-        
-        geo = InputMediaGeoPoint(InputGeoPoint(lat=alert.latitude, long=alert.longitude))
-        await user_client.send_file(alert.contact_phone, file=geo)
-        
-        return {"status": "sucesso", "message": "Alerta enviado!"}
-        
-    except Exception as e:
-        raise HTTPException(500, f"Erro envio: {str(e)}")
-    finally:
-        await user_client.disconnect()
\ No newline at end of file
+    return {"status": "enfileirado", "message": "Alerta na fila de envio!"}
+
+
+# Equivalente pela linha de comando:
+#   WEB_CONCURRENCY=2 uvicorn main:app --loop uvloop --http httptools
+# ou com gunicorn:
+#   WEB_CONCURRENCY=2 gunicorn main:app -k uvicorn.workers.UvicornWorker
+# Os dois servidores usam WEB_CONCURRENCY como número de workers; não passe
+# --workers/-w com outro valor, senão o limite de envio fica errado. Exporte
+# a variável no ambiente: os servidores não leem o .env.
+# (o UvicornWorker já usa uvloop/httptools quando estão instalados)
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop não existe no Windows; lá o uvicorn usa o loop padrão do asyncio
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=settings.port,
+        loop="auto" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=settings.web_concurrency
+    )
@@ -0,0 +1,106 @@
+import hashlib
+import hmac
+import json
+import secrets
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+SECRET = "segredo-de-teste"
+
+
+class FakeSnapshot:
+    exists = True
+
+    def get(self, field):
+        return "sessao" if field == "session_string" else None
+
+
+class FakeDocument:
+    async def get(self, field_paths=None):
+        return FakeSnapshot()
+
+    async def create(self, data):
+        return None
+
+
+class FakeCollection:
+    def document(self, doc_id):
+        return FakeDocument()
+
+
+class FakeDB:
+    def collection(self, name):
+        return FakeCollection()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "settings", main.Settings(alert_hmac_secret=SECRET))
+    monkeypatch.setattr(main, "db", FakeDB())
+    while not main.alert_queue.empty():
+        main.alert_queue.get_nowait()
+        main.alert_queue.task_done()
+    # Sem o "with": o lifespan (Firebase, pools, workers) não é executado
+    return TestClient(main.app)
+
+
+def signed_body():
+    # Coordenadas inteiras e espaço no fim: o pydantic normaliza os dois,
+    # mas a assinatura vale para os bytes enviados
+    payload = {
+        "phone": "+5511999990000",
+        "contact_phone": "+5511988880000",
+        "message": "socorro\n",
+        "latitude": -23,
+        "longitude": -46,
+        "ts": int(time.time()),
+        "nonce": secrets.token_hex(16),
+    }
+    body = json.dumps(payload).encode()
+    signature = hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return body, signature
+
+
+def post(client, body, signature=None):
+    headers = {"Content-Type": "application/json"}
+    if signature:
+        headers["X-Signature"] = signature
+    return client.post("/enviar-alerta", content=body, headers=headers)
+
+
+def test_accepts_signature_over_raw_body(client):
+    body, signature = signed_body()
+    response = post(client, body, signature)
+    assert response.status_code == 202
+    assert main.alert_queue.qsize() == 1
+
+
+def test_rejects_wrong_signature(client):
+    body, signature = signed_body()
+    response = post(client, body, "0" * len(signature))
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Assinatura inválida."
+
+
+def test_rejects_tampered_body(client):
+    body, signature = signed_body()
+    response = post(client, body.replace(b"socorro", b"tudo ok"), signature)
+    assert response.status_code == 401
+
+
+def test_rejects_missing_signature(client):
+    body, _ = signed_body()
+    response = post(client, body)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Assinatura ausente."
+
+
+def test_rejects_non_ascii_signature(client):
+    body, _ = signed_body()
+    response = post(client, body, "é".encode("latin-1"))
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Assinatura inválida."
@@ -0,0 +1,118 @@
+import asyncio
+
+from telethon.errors import UserPrivacyRestrictedError
+
+import main
+
+ALERT = main.AlertRequest(
+    phone="+5511999990000", contact_phone="+5511988880000",
+    message="socorro", latitude=-23, longitude=-46
+)
+
+
+def run_worker_once(monkeypatch, error):
+    discarded, requeued = [], []
+
+    async def deliver_alert(alert, session_str, random_ids):
+        raise error
+
+    async def discard_user_client(phone):
+        discarded.append(phone)
+
+    def schedule_requeue(alert, session_str, attempt, random_ids, delay):
+        requeued.append((attempt, random_ids))
+
+    monkeypatch.setattr(main, "deliver_alert", deliver_alert)
+    monkeypatch.setattr(main, "discard_user_client", discard_user_client)
+    monkeypatch.setattr(main, "schedule_requeue", schedule_requeue)
+
+    async def scenario():
+        # Fila nova, presa ao event loop deste teste
+        monkeypatch.setattr(main, "alert_queue", asyncio.Queue())
+        main.alert_queue.put_nowait((ALERT, "sessao", 0, (1, 2)))
+        worker = asyncio.create_task(main.alert_worker())
+        await main.alert_queue.join()
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+    asyncio.run(scenario())
+    return discarded, requeued
+
+
+def test_permanent_rpc_error_drops_alert_and_keeps_client(monkeypatch):
+    discarded, requeued = run_worker_once(monkeypatch, UserPrivacyRestrictedError(None))
+    assert discarded == []
+    assert requeued == []
+
+
+def test_unresolvable_contact_drops_alert_and_keeps_client(monkeypatch):
+    discarded, requeued = run_worker_once(monkeypatch, ValueError("Cannot find any entity"))
+    assert discarded == []
+    assert requeued == []
+
+
+def test_transport_error_reconnects_and_retries(monkeypatch):
+    discarded, requeued = run_worker_once(monkeypatch, ConnectionError("socket fechado"))
+    assert discarded == [ALERT.phone]
+    # Mesmos random_ids na nova tentativa: o Telegram descarta o que já chegou
+    assert requeued == [(1, (1, 2))]
+
+
+def test_drain_waits_for_alerts_pending_retry(monkeypatch):
+    delivered = []
+
+    async def deliver_alert(alert, session_str, random_ids):
+        if not delivered:
+            delivered.append(("falhou", random_ids))
+            raise ConnectionError("socket fechado")
+        delivered.append(("enviado", random_ids))
+
+    async def discard_user_client(phone):
+        pass
+
+    monkeypatch.setattr(main, "deliver_alert", deliver_alert)
+    monkeypatch.setattr(main, "discard_user_client", discard_user_client)
+
+    async def scenario():
+        monkeypatch.setattr(main, "alert_queue", asyncio.Queue())
+        main.alert_queue.put_nowait((ALERT, "sessao", 0, (1, 2)))
+        worker = asyncio.create_task(main.alert_worker())
+        # A primeira tentativa volta para a fila só depois do backoff (1 s)
+        await asyncio.wait_for(main.drain_alerts(), 5)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert delivered == [("falhou", (1, 2)), ("enviado", (1, 2))]
+
+
+def test_busy_recipient_does_not_block_other_contacts(monkeypatch):
+    delivered = []
+
+    async def deliver_alert(alert, session_str, random_ids):
+        await asyncio.sleep(0.1)
+        delivered.append((alert.contact_phone, alert.message))
+
+    monkeypatch.setattr(main, "deliver_alert", deliver_alert)
+
+    async def scenario():
+        monkeypatch.setattr(main, "alert_queue", asyncio.Queue())
+        monkeypatch.setattr(main, "send_limiter", main.TokenBucket(1000, 1000))
+        for i in range(8):
+            main.alert_queue.put_nowait((ALERT.model_copy(update={"message": str(i)}), "sessao", 0, (1, 2)))
+        other = ALERT.model_copy(update={"contact_phone": "+5511977770000"})
+        main.alert_queue.put_nowait((other, "sessao", 0, (1, 2)))
+
+        workers = [asyncio.create_task(main.alert_worker()) for _ in range(main.ALERT_WORKERS)]
+        await asyncio.sleep(0.15)
+        # O contato B já recebeu, sem esperar a fila do contato A
+        assert (other.contact_phone, other.message) in delivered
+        await asyncio.wait_for(main.alert_queue.join(), 2)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    asyncio.run(scenario())
+    # Os alertas do mesmo contato saem na ordem da fila
+    assert [m for c, m in delivered if c == ALERT.contact_phone] == [str(i) for i in range(8)]
+    assert main._recipient_backlog == {}
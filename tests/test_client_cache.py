@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+class FakeTelegramClient:
+    def __init__(self, session, api_id, api_hash):
+        self.connected = False
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        return True
+
+
+@pytest.fixture(autouse=True)
+def fake_clients(monkeypatch):
+    monkeypatch.setattr(main, "TelegramClient", FakeTelegramClient)
+    monkeypatch.setattr(main, "StringSession", str)
+    main.client_cache.clear()
+    yield
+    main.client_cache.clear()
+    main.auth_ok.clear()
+
+
+def test_discard_waits_for_send_in_progress():
+    async def scenario():
+        async with main.get_user_client("+5511999990000", "sessao") as cached:
+            client = cached.client
+            await main.discard_user_client("+5511999990000")
+            # Saiu do cache, mas o envio em andamento continua conectado
+            assert "+5511999990000" not in main.client_cache
+            assert client.is_connected()
+        assert not client.is_connected()
+
+    asyncio.run(scenario())
+
+
+def test_lru_overflow_skips_busy_clients(monkeypatch):
+    monkeypatch.setattr(main, "CLIENT_CACHE_MAX", 1)
+
+    async def scenario():
+        async with main.get_user_client("+5511000000001", "a") as first:
+            async with main.get_user_client("+5511000000002", "b") as second:
+                assert first.client.is_connected() and second.client.is_connected()
+                assert len(main.client_cache) == 2
+
+        async with main.get_user_client("+5511000000003", "c") as third:
+            assert list(main.client_cache) == ["+5511000000003"]
+            assert not first.client.is_connected() and not second.client.is_connected()
+            assert third.client.is_connected()
+
+    asyncio.run(scenario())
+
+
+def test_slow_reconnect_does_not_block_other_clients():
+    class SlowClient(FakeTelegramClient):
+        async def connect(self):
+            await asyncio.sleep(0.5)
+            await super().connect()
+
+    async def scenario():
+        slow = main.CachedClient(SlowClient(None, None, None))
+        fast = main.CachedClient(FakeTelegramClient(None, None, None))
+        slow_reconnect = asyncio.create_task(slow.reconnect())
+        await asyncio.sleep(0)
+        await asyncio.wait_for(fast.reconnect(), 0.1)
+        assert fast.client.is_connected()
+        await slow_reconnect
+
+    asyncio.run(scenario())
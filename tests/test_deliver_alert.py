@@ -0,0 +1,68 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telethon.errors import MsgWaitFailedError, MultiError, RandomIdDuplicateError
+from telethon.tl.functions.messages import SendMessageRequest, SendMediaRequest
+
+import main
+
+ALERT = main.AlertRequest(
+    phone="+5511999990000", contact_phone="+5511988880000",
+    message="socorro", latitude=-23, longitude=-46
+)
+
+
+class FakeClient:
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = []
+
+    async def __call__(self, requests, ordered=False):
+        self.calls.append((list(requests), ordered))
+        if self.errors:
+            error = self.errors.pop(0)
+            if error:
+                raise error
+
+    def is_connected(self):
+        return True
+
+
+def deliver(monkeypatch, client):
+    @asynccontextmanager
+    async def get_user_client(phone, session_str):
+        yield main.CachedClient(client)
+
+    async def get_peer(client, phone, contact_phone):
+        return "peer"
+
+    monkeypatch.setattr(main, "get_user_client", get_user_client)
+    monkeypatch.setattr(main, "get_peer", get_peer)
+    asyncio.run(main.deliver_alert(ALERT, "sessao", main.new_random_ids()))
+
+
+def test_sends_text_then_location_in_one_ordered_call(monkeypatch):
+    client = FakeClient()
+    deliver(monkeypatch, client)
+
+    [([text, geo], ordered)] = client.calls
+    assert ordered
+    assert isinstance(text, SendMessageRequest)
+    assert text.message.endswith("socorro")
+    assert isinstance(geo, SendMediaRequest)
+    assert geo.media.geo_point.lat == -23
+
+
+def test_retry_resends_only_what_did_not_arrive(monkeypatch):
+    # A conexão cai; na nova tentativa o texto já tinha chegado e a
+    # localização falhou por depender dele
+    duplicate = MultiError(
+        [RandomIdDuplicateError(None), MsgWaitFailedError(None)], [None, None],
+        [SendMessageRequest(peer=None, message=""), SendMessageRequest(peer=None, message="")]
+    )
+    client = FakeClient([ConnectionError("socket fechado"), duplicate])
+    deliver(monkeypatch, client)
+
+    (first, _), (retry, _), (last, _) = client.calls
+    assert [r.random_id for r in retry] == [r.random_id for r in first]
+    assert [r.random_id for r in last] == [first[1].random_id]
@@ -0,0 +1,33 @@
+import logging
+import logging.config
+
+import pytest
+from uvicorn.config import LOGGING_CONFIG
+
+import main
+
+
+@pytest.fixture
+def uvicorn_logging():
+    logging.config.dictConfig(LOGGING_CONFIG)
+    yield logging.getLogger("uvicorn")
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        log = logging.getLogger(name)
+        log.handlers.clear()
+        log.setLevel(logging.NOTSET)
+        log.propagate = True
+    main.logger.setLevel(logging.INFO)
+
+
+def test_listener_uses_uvicorn_handlers(uvicorn_logging):
+    # No LOGGING_CONFIG padrão o handler fica no "uvicorn", não no "uvicorn.error"
+    assert not logging.getLogger("uvicorn.error").handlers
+    # O --log-level do uvicorn vai para o "uvicorn.error"
+    logging.getLogger("uvicorn.error").setLevel(logging.WARNING)
+
+    listener = main.start_log_listener()
+    try:
+        assert list(listener.handlers) == uvicorn_logging.handlers
+        assert main.logger.level == logging.WARNING
+    finally:
+        listener.stop()
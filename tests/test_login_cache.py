@@ -0,0 +1,70 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    main.login_sessions.clear()
+    yield
+    main.login_sessions.clear()
+
+
+def test_recall_matches_login_id_and_phone():
+    main.remember_login("id-1", "+5511999990000", "hash", "sessao")
+    assert main.recall_login("id-1", "+5511999990000") == ("hash", "sessao")
+    assert main.recall_login("id-1", "+5511000000000") is None
+
+
+def test_repeated_step_1_elsewhere_misses_local_cache():
+    # Passo 1 aqui, repetido em outro worker: o cliente manda o login_id novo
+    main.remember_login("id-antigo", "+5511999990000", "hash-antigo", "sessao-antiga")
+    assert main.recall_login("id-novo", "+5511999990000") is None
+
+
+def test_missing_login_id_goes_to_firestore():
+    main.remember_login("id-1", "+5511999990000", "hash", "sessao")
+    assert main.recall_login(None, "+5511999990000") is None
+
+
+class FakeSnapshot:
+    exists = True
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, field):
+        return self.data[field]
+
+
+class FakeDocument:
+    def __init__(self, data):
+        self.data = data
+
+    async def get(self, field_paths=None):
+        return FakeSnapshot(self.data)
+
+
+class FakeDB:
+    def __init__(self, data):
+        self.data = data
+
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return FakeDocument(self.data)
+
+
+def test_step_2_rejects_replaced_attempt_from_firestore(monkeypatch):
+    monkeypatch.setattr(main, "db", FakeDB({
+        "login_id": "id-novo", "phone_code_hash": "hash",
+        "temp_session": "sessao", "expires_at": None,
+    }))
+    client = TestClient(main.app)
+    response = client.post("/autenticacao/finalizar", json={
+        "phone": "+5511999990000", "code": "12345", "login_id": "id-antigo"
+    })
+    assert response.status_code == 400
+    assert "login_id mais recente" in response.json()["detail"]
@@ -0,0 +1,9 @@
+import main
+
+
+def test_empty_variables_count_as_unset(monkeypatch):
+    monkeypatch.setenv("TELEGRAM_API_ID", "")
+    monkeypatch.setenv("WEB_CONCURRENCY", "")
+    settings = main.Settings(_env_file=None)
+    assert settings.telegram_api_id is None
+    assert settings.web_concurrency == 1